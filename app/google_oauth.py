@@ -1,12 +1,21 @@
 # app/google_oauth.py
 import os
 import json
+import functools
 import re
+import threading
 from pathlib import Path
 from datetime import datetime, timezone
 
+try:
+    import orjson
+except ImportError:  # opcional: si no está, usamos json de la stdlib
+    orjson = None
+
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request as GoogleAuthRequest
 
 # OJO: usás /userinfo para obtener el email => necesitás estos scopes.
 # (Evita el warning de "Scope has changed" y problemas raros de refresh.)
@@ -22,43 +31,86 @@ CREDS_DIR = APP_DIR / "credentials"
 TOKENS_DIR = CREDS_DIR / "tokens"
 CLIENT_SECRET_PATH = CREDS_DIR / "client_secret.json"
 
+# Se crea una vez al importar (no en cada save).
+try:
+    TOKENS_DIR.mkdir(parents=True, exist_ok=True)
+except OSError:
+    pass
+
+_SAFE_FILENAME_RE = re.compile(r"[^a-z0-9._-]+")
+
+# Cache en memoria de credenciales: path -> (mtime_ns, Credentials).
+# Se comparte la misma instancia (google-auth refresca token/expiry in-place).
+# Si el archivo cambia (mtime distinto) se vuelve a leer.
+_CREDS_CACHE: dict[Path, tuple[int, Credentials]] = {}
+_CREDS_LOCK = threading.Lock()
+# Un lock por token para que dos requests del mismo usuario no refresquen
+# a la vez la instancia compartida.
+_REFRESH_LOCKS: dict[Path, threading.Lock] = {}
+_CLIENT_SECRET_LOCK = threading.Lock()
+
 
 # -----------------------------
 # Client secret (local file o env en Render)
 # -----------------------------
-def _ensure_client_secret_file() -> None:
+def _get_client_config() -> dict:
     """
-    En local podés tener credentials/client_secret.json.
-    En Render NO lo subimos al repo: lo armamos desde GOOGLE_CLIENT_SECRET_JSON.
+    Parsea GOOGLE_CLIENT_SECRET_JSON (acepta JSON puro o "escapado").
     """
-    if CLIENT_SECRET_PATH.exists():
-        return
-
     raw = (os.getenv("GOOGLE_CLIENT_SECRET_JSON") or "").strip()
     if not raw:
         raise RuntimeError(
             "Falta GOOGLE_CLIENT_SECRET_JSON (env) y no existe credentials/client_secret.json"
         )
 
-    CREDS_DIR.mkdir(parents=True, exist_ok=True)
-
-    # Acepta JSON puro o JSON "escapado"
     try:
-        data = json.loads(raw)
+        return json.loads(raw)
     except json.JSONDecodeError:
-        data = json.loads(raw.encode("utf-8").decode("unicode_escape"))
+        return json.loads(raw.encode("utf-8").decode("unicode_escape"))
+
+
+@functools.lru_cache(maxsize=1)
+def _client_config() -> dict:
+    """
+    Config OAuth, resuelta una sola vez por proceso.
+    En local podés tener credentials/client_secret.json.
+    En Render NO lo subimos al repo: lo armamos desde GOOGLE_CLIENT_SECRET_JSON
+    (y de paso lo dejamos escrito en disco).
+    """
+    with _CLIENT_SECRET_LOCK:
+        if CLIENT_SECRET_PATH.exists():
+            return json.loads(CLIENT_SECRET_PATH.read_text(encoding="utf-8"))
+
+        data = _get_client_config()
+        CREDS_DIR.mkdir(parents=True, exist_ok=True)
+        CLIENT_SECRET_PATH.write_text(
+            json.dumps(data, ensure_ascii=False, indent=2),
+            encoding="utf-8",
+        )
+        return data
+
 
-    CLIENT_SECRET_PATH.write_text(
-        json.dumps(data, ensure_ascii=False, indent=2),
-        encoding="utf-8",
+def _build_flow(redirect_uri: str) -> Flow:
+    return Flow.from_client_config(
+        _client_config(),
+        scopes=SCOPES,
+        redirect_uri=redirect_uri,
     )
 
 
+@functools.lru_cache(maxsize=1)
 def _base_url() -> str:
     # ej: http://localhost:8000 o https://crm-followups.onrender.com
+    # Se lee en el primer uso (no al importar): main.py llama a load_dotenv()
+    # después de importar este módulo.
     return os.environ.get("BASE_URL", "http://localhost:8000").rstrip("/")
 
 
+@functools.lru_cache(maxsize=1)
+def _redirect_uri() -> str:
+    return f"{_base_url()}/auth/callback"
+
+
 # -----------------------------
 # Expiry helpers (FIX: naive vs aware)
 # -----------------------------
@@ -82,6 +134,15 @@ def _parse_expiry(value):
     if not value:
         return None
 
+    # Camino rápido: lo que guarda _serialize_expiry ("...Z", ya en UTC).
+    if isinstance(value, str) and len(value) >= 20 and value[-1] == "Z":
+        try:
+            dt = datetime.fromisoformat(value[:-1])
+        except ValueError:
+            dt = None
+        if dt is not None and dt.tzinfo is None:
+            return dt
+
     if isinstance(value, datetime):
         dt = value
     elif isinstance(value, str):
@@ -110,9 +171,7 @@ def _parse_expiry(value):
 # Token paths (vendor + email)
 # -----------------------------
 def _safe_filename(s: str) -> str:
-    s = s.strip().lower()
-    s = re.sub(r"[^a-z0-9._-]+", "_", s)
-    return s
+    return _SAFE_FILENAME_RE.sub("_", s.strip().lower())
 
 
 def _token_path(vendor_id: str) -> Path:
@@ -131,14 +190,7 @@ def get_auth_url(vendor_id: str) -> str:
     Devuelve URL de consentimiento.
     state = vendor_id (para tokens por vendedor o login).
     """
-    _ensure_client_secret_file()
-    redirect_uri = f"{_base_url()}/auth/callback"
-
-    flow = Flow.from_client_secrets_file(
-        str(CLIENT_SECRET_PATH),
-        scopes=SCOPES,
-        redirect_uri=redirect_uri,
-    )
+    flow = _build_flow(_redirect_uri())
 
     auth_url, _ = flow.authorization_url(
         access_type="offline",
@@ -153,14 +205,7 @@ def exchange_code_for_creds(code: str, vendor_id: str) -> Credentials:
     """
     Intercambia el code por credenciales y guarda token por vendor_id.
     """
-    _ensure_client_secret_file()
-    redirect_uri = f"{_base_url()}/auth/callback"
-
-    flow = Flow.from_client_secrets_file(
-        str(CLIENT_SECRET_PATH),
-        scopes=SCOPES,
-        redirect_uri=redirect_uri,
-    )
+    flow = _build_flow(_redirect_uri())
     flow.fetch_token(code=code)
 
     creds = flow.credentials
@@ -169,11 +214,43 @@ def exchange_code_for_creds(code: str, vendor_id: str) -> Credentials:
 
 
 # -----------------------------
-# Save / Load creds (vendor)
+# Save / Load creds (compartido)
 # -----------------------------
-def save_creds_for_vendor(vendor_id: str, creds: Credentials) -> None:
-    TOKENS_DIR.mkdir(parents=True, exist_ok=True)
+def _json_loads(raw: bytes) -> dict:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 
+def _json_dumps(payload: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def _atomic_write_json(path: Path, payload: dict) -> int:
+    """
+    JSON compacto a un .tmp y os.replace: si el proceso muere a mitad
+    de la escritura, el token anterior queda intacto.
+    Devuelve el mtime_ns del archivo que escribimos nosotros.
+    """
+    # .tmp propio por proceso/thread: dos saves del mismo token (ej. login.json
+    # con logins concurrentes) no se pisan el archivo temporal.
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        tmp.write_bytes(_json_dumps(payload))
+        # stat del .tmp (antes del replace): si otro writer reemplaza path
+        # después, este mtime sigue siendo el de nuestro archivo.
+        mtime_ns = tmp.stat().st_mtime_ns
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return mtime_ns
+
+
+def _save_creds_to_path(path: Path, creds: Credentials) -> None:
+    # Armamos el dict a mano (nunca creds.to_json(): serializa de más).
     payload = {
         "token": creds.token,
         "refresh_token": creds.refresh_token,
@@ -183,59 +260,149 @@ def save_creds_for_vendor(vendor_id: str, creds: Credentials) -> None:
         "scopes": creds.scopes or SCOPES,
         "expiry": _serialize_expiry(getattr(creds, "expiry", None)),
     }
-    _token_path(vendor_id).write_text(
-        json.dumps(payload, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+    mtime_ns = _atomic_write_json(path, payload)
 
+    # Dejamos en el cache la misma instancia que acabamos de guardar: el
+    # próximo load no necesita releer ni parsear el archivo. Si otro writer
+    # pisó el archivo, su mtime no coincide y el load lo relee.
+    with _CREDS_LOCK:
+        _CREDS_CACHE[path] = (mtime_ns, creds)
 
-def load_creds_for_vendor(vendor_id: str) -> Credentials | None:
-    path = _token_path(vendor_id)
-    if not path.exists():
-        return None
 
-    data = json.loads(path.read_text(encoding="utf-8"))
+def _read_token_file(path: Path, mtime_ns: int) -> Credentials:
+    """Lee un token, arma las Credentials y las deja en _CREDS_CACHE."""
+    data = _json_loads(path.read_bytes())
+    if not isinstance(data, dict):
+        # JSON válido pero no es un objeto (null, [], etc.): token roto
+        raise ValueError(f"Token inválido en {path.name}")
     if "expiry" in data:
         data["expiry"] = _parse_expiry(data.get("expiry"))
 
-    # from_authorized_user_info es más tolerante
+    # El payload que guardamos tiene las keys que espera from_authorized_user_info;
+    # cualquier token roto termina en ValueError (lo maneja _load_creds_from_path).
+    creds = Credentials.from_authorized_user_info(data, scopes=SCOPES)
+    _CREDS_CACHE[path] = (mtime_ns, creds)
+    return creds
+
+
+def _refresh_lock(path: Path) -> threading.Lock:
+    with _CREDS_LOCK:
+        lock = _REFRESH_LOCKS.get(path)
+        if lock is None:
+            lock = _REFRESH_LOCKS[path] = threading.Lock()
+        return lock
+
+
+def _ensure_fresh(path: Path, creds: Credentials) -> Credentials | None:
+    """
+    Refresca la instancia compartida si expiró, con el lock del token: así
+    googleapiclient la recibe válida y no la refresca en paralelo.
+    """
+    if creds.valid:
+        return creds
+
+    with _refresh_lock(path):
+        # otro thread pudo haberla refrescado mientras esperábamos
+        if creds.valid or not creds.refresh_token:
+            return creds
+        try:
+            creds.refresh(GoogleAuthRequest())
+        except RefreshError:
+            # refresh_token revocado/vencido: como si no hubiera token
+            with _CREDS_LOCK:
+                _CREDS_CACHE.pop(path, None)
+            return None
+    return creds
+
+
+def _load_creds_from_path(path: Path) -> Credentials | None:
+    """
+    Devuelve las credenciales (refrescadas si hacía falta) de un token.
+    """
+    creds = _get_cached_creds(path)
+    if creds is None:
+        return None
+    return _ensure_fresh(path, creds)
+
+
+def _get_cached_creds(path: Path) -> Credentials | None:
+    """
+    Lee el token de disco solo si cambió (mtime); si no, usa el cache.
+    """
     try:
-        return Credentials.from_authorized_user_info(data, scopes=SCOPES)
-    except Exception:
-        return Credentials(**data)
+        st = path.stat()
+    except FileNotFoundError:
+        _CREDS_CACHE.pop(path, None)
+        return None
+
+    cached = _CREDS_CACHE.get(path)
+    if cached is not None and cached[0] == st.st_mtime_ns:
+        return cached[1]
+
+    with _CREDS_LOCK:
+        # otro thread pudo haberlo cargado mientras esperábamos el lock
+        cached = _CREDS_CACHE.get(path)
+        if cached is not None and cached[0] == st.st_mtime_ns:
+            return cached[1]
+        try:
+            return _read_token_file(path, st.st_mtime_ns)
+        except FileNotFoundError:
+            # lo borraron entre el stat y la lectura
+            _CREDS_CACHE.pop(path, None)
+            return None
+        except ValueError:
+            # token roto (JSON inválido, no es un objeto o faltan keys): como
+            # si no hubiera token, así el usuario vuelve a pasar por /login.
+            _CREDS_CACHE.pop(path, None)
+            return None
+
+
+# -----------------------------
+# Save / Load creds (vendor)
+# -----------------------------
+def save_creds_for_vendor(vendor_id: str, creds: Credentials) -> None:
+    _save_creds_to_path(_token_path(vendor_id), creds)
+
+
+def load_creds_for_vendor(vendor_id: str) -> Credentials | None:
+    return _load_creds_from_path(_token_path(vendor_id))
 
 
 # -----------------------------
 # Save / Load creds (email) - usado por main.py
 # -----------------------------
 def save_creds_for_email(email: str, creds: Credentials) -> None:
-    TOKENS_DIR.mkdir(parents=True, exist_ok=True)
-
-    payload = {
-        "token": creds.token,
-        "refresh_token": creds.refresh_token,
-        "token_uri": creds.token_uri,
-        "client_id": creds.client_id,
-        "client_secret": creds.client_secret,
-        "scopes": creds.scopes or SCOPES,
-        "expiry": _serialize_expiry(getattr(creds, "expiry", None)),
-    }
-    token_path_for_email(email).write_text(
-        json.dumps(payload, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+    _save_creds_to_path(token_path_for_email(email), creds)
 
 
 def load_creds_for_email(email: str) -> Credentials | None:
-    path = token_path_for_email(email)
-    if not path.exists():
-        return None
+    return _load_creds_from_path(token_path_for_email(email))
 
-    data = json.loads(path.read_text(encoding="utf-8"))
-    if "expiry" in data:
-        data["expiry"] = _parse_expiry(data.get("expiry"))
 
-    try:
-        return Credentials.from_authorized_user_info(data, scopes=SCOPES)
-    except Exception:
-        return Credentials(**data)
+# -----------------------------
+# Precarga de tokens al arrancar
+# -----------------------------
+def _load_token_index() -> None:
+    """
+    Son pocos tokens y chicos: los parseamos todos al importar, así los
+    loads posteriores solo hacen un stat (para detectar cambios de otro
+    proceso) y salen del cache.
+    """
+    with os.scandir(TOKENS_DIR) as it:
+        for entry in it:
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                # misma key que arma _token_path / token_path_for_email
+                _read_token_file(TOKENS_DIR / entry.name, entry.stat().st_mtime_ns)
+            except (OSError, ValueError):
+                # archivo roto o que desapareció: se resuelve en el load
+                continue
+
+
+try:
+    _load_token_index()
+except OSError:
+    pass
@@ -155,6 +155,8 @@ def logout(request: Request):
 
 @app.get("/auth/callback")
 def auth_callback(request: Request, code: str, state: str):
+    # def sync a propósito: FastAPI lo corre en su threadpool, así que el
+    # fetch_token y el /userinfo no bloquean el event loop.
     creds = exchange_code_for_creds(code=code, vendor_id=state)
     email = get_google_user_email(creds)
 